@@ -1,20 +1,33 @@
 """Analyze Home Assistant Solar Production."""
 
-import datetime as dt
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from math import ceil
 from pathlib import Path
 
+import matplotlib as mpl
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
+import numpy as np
 import pandas as pd
+from matplotlib.axes import Axes
+
+# non-interactive backend, we only write PNG files
+mpl.use("Agg")
 
 # SENSOR_NAME = "sensor.plug1_pv_energy"
 SENSOR_ID = 9
 # from SELECT * FROM statistics_meta WHERE statistic_id = 'sensor.plug1_pv_energy';
 # MAX_KWH_PER_HOUR = 0.63
 
+# all single-axes plots reuse this figure, saves a figure setup per plot
+FIG_NUM_REUSED = 1
+
+FILE_DB = Path("home-assistant_v2.db")
+FILE_CACHE = Path(f"cache/sensor-{SENSOR_ID}.parquet")
+
 
 def read_database() -> pd.DataFrame:
     """
@@ -22,19 +35,53 @@ def read_database() -> pd.DataFrame:
 
     returns pandas.DataFrame
     """
-    con = sqlite3.connect("home-assistant_v2.db")
-
     # note: column 'state' is reset from time to time, better use 'sum'
+    # convert continuous meter reading (fortlaufender Zählerstand) to kWh per hour
+    # via window function, compares to next row
     sql = """
-    SELECT start_ts, sum as 'kWh_sum'
+    SELECT start_ts, LEAD(sum) OVER (ORDER BY created_ts) - sum as 'kWh'
     FROM statistics
     WHERE statistics.metadata_id = ?
     ORDER BY created_ts ASC
     """
-    df = pd.read_sql_query(
-        sql, con, params=(SENSOR_ID,)
-    )  # using bind variable of hard coded value
-    con.close()
+    # sqlite3 connection as context manager does not close it, closing() does
+    with closing(sqlite3.connect(FILE_DB)) as con:
+        # read only, memory-map the file (256 MB), 64 MB page cache,
+        # temp b-trees of the window function in memory
+        con.executescript(
+            """
+            PRAGMA query_only=1;
+            PRAGMA mmap_size=268435456;
+            PRAGMA cache_size=-65536;
+            PRAGMA temp_store=MEMORY;
+            """
+        )
+        df = pd.read_sql_query(
+            sql,
+            con,
+            params=(SENSOR_ID,),  # using bind variable of hard coded value
+            dtype={"start_ts": "float64[pyarrow]", "kWh": "float64[pyarrow]"},
+            dtype_backend="pyarrow",
+        )
+    return df
+
+
+def read_database_cached() -> pd.DataFrame:
+    """
+    Read Home Assistant data from Parquet cache or SQLite database.
+
+    cache is used if newer than the database and this script (SQL and dtypes),
+    else it is (re-)created
+    returns pandas.DataFrame
+    """
+    if FILE_CACHE.exists() and FILE_CACHE.stat().st_mtime > max(
+        FILE_DB.stat().st_mtime, Path(__file__).stat().st_mtime
+    ):
+        return pd.read_parquet(FILE_CACHE, engine="pyarrow", dtype_backend="pyarrow")
+
+    df = read_database()
+    FILE_CACHE.parent.mkdir(exist_ok=True)
+    df.to_parquet(FILE_CACHE, engine="pyarrow", compression="zstd")
     return df
 
 
@@ -43,7 +90,6 @@ def prepare_df_hours(df: pd.DataFrame) -> pd.DataFrame:
     Prepare DataFrame of hour sums in local timezone.
 
     timestamp to datetime
-    kWh sum per hour
     """
     # convert timestamp to datetime and use as index
     df["datetime"] = pd.to_datetime(  # convert to datetime
@@ -55,11 +101,8 @@ def prepare_df_hours(df: pd.DataFrame) -> pd.DataFrame:
     )
     df = df.set_index("datetime")
 
-    # convert continuous meter reading (fortlaufender Zählerstand) to kWh per hour
-    df["kWh"] = df["kWh_sum"].shift(-1) - df["kWh_sum"]  # compares to next row
-
     # remove unnecessary columns
-    df = df.drop(columns=["start_ts", "kWh_sum"])
+    df = df.drop(columns=["start_ts"])
 
     # print(df)
     return df
@@ -67,36 +110,47 @@ def prepare_df_hours(df: pd.DataFrame) -> pd.DataFrame:
 
 def prepare_df_hours_goal_reached(
     df_hour: pd.DataFrame,
-    wh_target: int = 100,
-) -> pd.DataFrame:
+    wh_targets: tuple[int, ...] = (50, 100, 200),
+) -> dict[int, pd.DataFrame]:
     """
-    Analyze how many hours per day did I get more than 100 Wh.
+    Analyze how many hours per day did I get more than 50, 100, 200 Wh.
 
+    all targets are checked in one pass over the hours
+    returns dict of target Wh -> DataFrame
     index: date
     column: hours that reached the target kWh, rolling average of 7 days
     """
-    date_last_source = str(df_hour.index[-1].date())  # str to remove timezone
-
-    df = df_hour[df_hour["kWh"] >= wh_target / 1000].copy()
-    if len(df) == 0:
-        s = f"No hours reached target of {wh_target} Wh."
-        raise Exception(s)  # noqa: TRY002
-
-    df["date"] = pd.to_datetime(df.index.date)  # type: ignore
-    df = df.groupby(["date"]).agg(count=("kWh", "count"))
-    date_last = str(df.index[-1].date())
+    # compare each hour to all targets at once, shape (hours, targets)
+    kwh = df_hour["kWh"].to_numpy(dtype="float64", na_value=np.nan)
+    reached = kwh[:, np.newaxis] >= np.array(wh_targets) / 1000
+
+    # group by local day, includes missing dates as 0
+    df_count = (
+        pd.DataFrame(reached, index=df_hour.index, columns=wh_targets)
+        .groupby(pd.Grouper(freq="D"))
+        .sum()
+    )
+    df_count.index = df_count.index.tz_localize(None)  # type: ignore
+    # each target starts at first day that reached it, end is last day of source
+    df_count = df_count.where(df_count.ne(0).cummax())
+    # rolling average of all targets in one go, NaN days are skipped
+    df_roll = df_count.rolling(window=7, min_periods=1).mean().round(1)
 
-    if date_last != date_last_source:
-        df.loc[pd.to_datetime(date_last_source)] = 0  # type: ignore
+    d = {}
+    for wh_target in wh_targets:
+        if df_count[wh_target].isna().all():
+            s = f"No hours reached target of {wh_target} Wh."
+            raise Exception(s)  # noqa: TRY002
 
-    df = df.reindex(
-        pd.date_range(df.index.min(), df.index.max(), freq="D"), fill_value=0
-    )
-    df.index.name = "date"
-    df["roll"] = df["count"].rolling(window=7, min_periods=1).mean().round(1)
+        df = pd.DataFrame(
+            {"count": df_count[wh_target], "roll": df_roll[wh_target]}
+        ).dropna()
+        df["count"] = df["count"].astype("int8")  # max 25 hours per day
+        df.index.name = "date"
+        d[wh_target] = df
 
-    # print(df)
-    return df
+    # print(d)
+    return d
 
 
 def prepare_df_day(df: pd.DataFrame) -> pd.DataFrame:
@@ -104,53 +158,30 @@ def prepare_df_day(df: pd.DataFrame) -> pd.DataFrame:
     Prepare DataFrame of day sums from hour-sums.
 
     date-index
-    has columns for year, month, week
     """
-    # add column date from DateTime index
-    df["date"] = pd.to_datetime(df.index.date)  # type: ignore
-    df = df[["kWh", "date"]].groupby(["date"]).sum()
-    # add missing dates
-    df = df.reindex(
-        pd.date_range(df.index.min(), df.index.max(), freq="D"), fill_value=0
-    )
+    # resample to local days of DateTime index, includes missing dates as 0
+    df = df["kWh"].resample("D").sum().to_frame()
+    # drop timezone, date-index is midnight
+    df.index = df.index.tz_localize(None)  # type: ignore
     df.index.name = "date"
-    df["year"] = df.index.year  # type: ignore
-    df["month"] = df.index.month  # type: ignore
-    df["week"] = df.index.isocalendar().week  # type: ignore
-    # df["month_start"] = df.index - pd.offsets.MonthBegin(1)
-    # df["week_start"] = df.index - pd.offsets.Week(weekday=0)
 
     # print(df)
     return df
 
 
-def get_date_of_week_start(year, week_number) -> dt.date:  # noqa: ANN001
-    """Calc date of week start from year, week-no."""
-    date = dt.date.fromisocalendar(int(year), int(week_number), 1)
-    return date
-
-
 def prepare_df_week(df_day: pd.DataFrame) -> pd.DataFrame:
     """
     Prepare DataFrame of week sums.
 
-    date-index
+    date-index of week start (Monday)
     has kWh sum and day-mean
-    has columns for year, week
     """
+    # bins and sum/mean in one pass, labelled with the Monday the week starts
     df = (
-        df_day[["kWh", "year", "week"]]
-        .groupby(["year", "week"])
-        .agg(kWh_sum=("kWh", "sum"), kWh_mean=("kWh", "mean"))
+        df_day["kWh"]
+        .resample("W-MON", label="left", closed="left")
+        .agg(kWh_sum="sum", kWh_mean="mean")
     )
-    df = df.reset_index()
-
-    df["date"] = df.apply(
-        lambda row: get_date_of_week_start(row["year"], row["week"]),
-        axis=1,
-    )
-    df["date"] = pd.to_datetime(df["date"])
-    df = df.set_index("date")
 
     # print(df)
     return df
@@ -160,21 +191,11 @@ def prepare_df_month(df_day: pd.DataFrame) -> pd.DataFrame:
     """
     Prepare DataFrame of month sums.
 
-    date-index
+    date-index of month start
     has kWh sum and day-mean
-    has columns for year, month
     """
-    df = (
-        df_day[["kWh", "year", "month"]]
-        .groupby(["year", "month"])
-        .agg(kWh_sum=("kWh", "sum"), kWh_mean=("kWh", "mean"))
-    )
-    df = df.reset_index()
-
-    df["date"] = pd.to_datetime(
-        df["year"].astype(str) + "-" + df["month"].astype(str) + "-01"
-    )
-    df = df.set_index("date")
+    # bins and sum/mean in one pass, labelled with the month start
+    df = df_day["kWh"].resample("MS").agg(kWh_sum="sum", kWh_mean="mean")
 
     # print(df)
     return df
@@ -184,43 +205,69 @@ def prepare_df_last_14_days(df: pd.DataFrame) -> pd.DataFrame:
     """
     Prepare a DataFrame of hours of the last 14 days.
     """
-    # do not modify original
-    df = df.copy()
-    # drop timezone to make it easier
-    df.index = df.index.tz_localize(None)  # type: ignore
-
     # select last 14 days
-    df = df[df.index > (df.index[-1] - pd.DateOffset(days=14)).normalize()]
+    df = df.loc[df.index > (df.index[-1] - pd.DateOffset(days=14)).normalize()]
+    # drop timezone of the small slice to make it easier
+    df = df.tz_localize(None)
     # TODO: starts at 01:00:00+01:00 instead of 0:00
-    df["date"] = pd.to_datetime(df.index.date)  # type: ignore
-    last_day = df["date"].iloc[-1]
-    df["days_past"] = (last_day - pd.to_datetime(df["date"])).dt.days  # type: ignore
-    df["time"] = df.index.time  # type: ignore
-    df["hour"] = df.index.hour  # type: ignore
+    # truncate in int64 nanoseconds instead of python date objects
+    dates = df.index.floor("D")
+    df["date"] = dates
+    df["days_past"] = (dates[-1] - dates).days.astype("int16")
+    df["hour"] = df.index.hour.astype("int8")
 
     # print(df)
     return df
 
 
+def downsample_min_max(s: pd.Series, n_out: int = 2000) -> pd.Series:
+    """
+    Downsample a long series for plotting, keeping min and max per bucket.
+
+    returns the series unchanged if it has not more than n_out values
+    """
+    if len(s) <= n_out:
+        return s
+    s = s.dropna()
+    # n_out/2 buckets of consecutive values, each contributes its min and max
+    bucket = np.arange(len(s)) * (n_out // 2) // len(s)
+    # buckets are ascending already, no need to sort the keys
+    g = pd.Series(s.to_numpy(dtype="float64")).groupby(bucket, sort=False)
+    pos = np.union1d(g.idxmin().to_numpy(), g.idxmax().to_numpy())
+    return s.iloc[pos]
+
+
 def plot_kwh_vs_date(
     df: pd.DataFrame,
     grouper: str,
     kwh_sum: int = 0,
     kwh_max: float = 0,
+    ax: Axes | None = None,
 ) -> None:
     """
     Plot kWh per grouper (hour, day, week, month) over all time.
+
+    ax: optional Axes to reuse, is cleared before plotting
     """
     file_name = f"kWh-date-{grouper}"
     print("plot", file_name)
-    plt.suptitle(f"kWh per {grouper}")
-    fig, ax = plt.subplots()
-    if grouper in ("hour", "day"):
-        df["kWh"].plot(legend=False, drawstyle="steps-post")
+    if ax is None:
+        fig, ax = plt.subplots(num=FIG_NUM_REUSED, clear=True)
     else:
-        # kWh as sub-index "mean and sum"
-        # ax.step(df["kWh"]["sum"], df["kWh"].index)
-        df["kWh_sum"].plot(legend=False, drawstyle="steps-post")
+        ax.clear()
+        fig = ax.get_figure()
+        plt.sca(ax)  # plot_format uses the current Axes
+    fig.suptitle(f"kWh per {grouper}")
+    s = downsample_min_max(df["kWh"]) if grouper in ("hour", "day") else df["kWh_sum"]
+    # plain matplotlib step plot, rasterized for vector output formats
+    ax.step(
+        s.index,
+        s.to_numpy(dtype="float64", na_value=np.nan),
+        where="post",
+        rasterized=True,
+    )
+    # tight x range like pandas plotting
+    ax.margins(x=0)
 
     if kwh_sum > 0:
         ax.text(
@@ -240,8 +287,7 @@ def plot_kwh_vs_date(
         )
     plot_format(ax)
 
-    plt.savefig(fname=f"{file_name}.png", format="png")
-    plt.close()
+    fig.savefig(fname=f"{file_name}.png", format="png", dpi=100)
 
 
 def plot_kwh_date_mean(
@@ -253,7 +299,7 @@ def plot_kwh_date_mean(
     """Plot kWh per day, week and month (averaged) over all time."""
     file_name = "kWh-date-joined"
     print("plot", file_name)
-    fig, ax = plt.subplots()
+    fig, ax = plt.subplots(num=FIG_NUM_REUSED, clear=True)
     df_day["kWh"].plot(legend=True, drawstyle="steps-post")
     df_week["kWh_mean"].plot(drawstyle="steps-post", linewidth=2.0)
     df_month["kWh_mean"].plot(drawstyle="steps-post", linewidth=3.0)
@@ -274,8 +320,7 @@ def plot_kwh_date_mean(
     ax.set_ylim(0, MAX_KWH_PER_DAY)
     plt.ylabel("Kilowatt hours (kWh) per day")
 
-    plt.savefig(fname=f"{file_name}.png", format="png")
-    plt.close()
+    fig.savefig(fname=f"{file_name}.png", format="png", dpi=100)
 
 
 def plot_format(ax) -> None:  # noqa: ANN001
@@ -304,14 +349,27 @@ def plot_last_14_days(df_hour2: pd.DataFrame) -> None:
     fig.subplots_adjust(hspace=0)
     plt.suptitle(f"Last {days} days")
 
-    for i in range(days):
-        date_to_plot = df_hour2[df_hour2["days_past"] == i]["date"].iloc[0]
+    # matrix of kWh per day and hour, shape (days, 24), built once for all days
+    # keys are not sorted, as reindex puts them in order
+    hours = np.arange(24)
+    kwh_matrix = (
+        df_hour2.pivot_table(
+            index="days_past", columns="hour", values="kWh", aggfunc="sum", sort=False
+        )
+        .reindex(index=range(days), columns=hours, fill_value=0)
+        .to_numpy(dtype="float64", na_value=0)
+    )
+    # date and kWh sum of all days in one go, looked up by label below
+    df_days = df_hour2.groupby("days_past", sort=False).agg(
+        date=("date", "first"), kWh_sum=("kWh", "sum")
+    )
 
-        df = df_hour2[df_hour2["days_past"] == i][["kWh", "hour"]]
-        df = df.set_index("hour")
-        kwh_sum = df["kWh"].sum()
+    for i in range(days):
+        date_to_plot = df_days.loc[i, "date"]
+        kwh_sum = df_days.loc[i, "kWh_sum"]
 
-        df.plot.bar(legend=False, ax=ax[i], width=1.0)
+        # plain matplotlib bars at the hour, no pandas plotting layer
+        ax[i].bar(hours, kwh_matrix[i], width=1.0)
 
         plt.text(
             0.99,
@@ -327,7 +385,7 @@ def plot_last_14_days(df_hour2: pd.DataFrame) -> None:
     # set same x+y range
     ax[0].set_xlim(4, 20)
     ax[0].set_ylim(0, MAX_KWH_PER_HOUR)
-    plt.xticks(rotation=0)
+    ax[0].set_xticks(range(4, 21))
 
     fig.supxlabel("Hour of the Day")
     fig.supylabel(f"kWh per Hour (max {round(MAX_KWH_PER_HOUR,1)}kWh)")
@@ -338,8 +396,8 @@ def plot_last_14_days(df_hour2: pd.DataFrame) -> None:
         left=None, bottom=None, right=None, top=None, wspace=None, hspace=None
     )
 
-    plt.savefig(fname=f"{file_name}.png", format="png")
-    plt.close()
+    fig.savefig(fname=f"{file_name}.png", format="png", dpi=100)
+    plt.close(fig)
 
 
 def plot_hours_goal_reached(df: pd.DataFrame, wh_target: int) -> None:
@@ -349,7 +407,7 @@ def plot_hours_goal_reached(df: pd.DataFrame, wh_target: int) -> None:
     file_name = f"hours-of-{wh_target}Wh"
     print("plot", file_name)
 
-    fig, ax = plt.subplots()
+    fig, ax = plt.subplots(num=FIG_NUM_REUSED, clear=True)
     df.plot(
         legend=False,
         ax=ax,
@@ -361,13 +419,12 @@ def plot_hours_goal_reached(df: pd.DataFrame, wh_target: int) -> None:
     plot_format(ax)
     plt.ylabel("Count of hours of >= 100kWh")
 
-    plt.savefig(fname=f"{file_name}.png", format="png")
-    plt.close()
+    fig.savefig(fname=f"{file_name}.png", format="png", dpi=100)
 
 
 if __name__ == "__main__":
     # 1. data preparation
-    df_hour = prepare_df_hours(read_database())
+    df_hour = prepare_df_hours(read_database_cached())
     df_day = prepare_df_day(df_hour)
     df_week = prepare_df_week(df_day)
     df_month = prepare_df_month(df_day)
@@ -385,32 +442,53 @@ if __name__ == "__main__":
 
     # 2.2 how much solar power is consumed, how much is donated to the grid
     CONSUMPTION_WATT_PER_HOUR = 150
-    df = df_hour.copy()
-    df["kWh_used"] = df["kWh"].clip(upper=CONSUMPTION_WATT_PER_HOUR / 1000)
-    df["kWh_donated"] = df["kWh"] - df["kWh_used"]
-    print(f"kWh used: {df['kWh_used'].sum():.1f} kWh")
-    print(f"kWh donated: {df['kWh_donated'].sum():.1f} kWh")
+    kwh = df_hour["kWh"].to_numpy(dtype="float64", na_value=np.nan)
+    kwh_used = np.nansum(np.minimum(kwh, CONSUMPTION_WATT_PER_HOUR / 1000))
+    kwh_donated = np.nansum(kwh) - kwh_used
+    print(f"kWh used: {kwh_used:.1f} kWh")
+    print(f"kWh donated: {kwh_donated:.1f} kWh")
 
     # 3. export and plotting
-    # 3.1 export
     Path("out").mkdir(exist_ok=True)
-    df_day["kWh"].round(3).to_csv("out/day.csv")
-    df_week[["kWh_sum", "kWh_mean"]].round(3).to_csv("out/week.csv")
-    df_month[["kWh_sum", "kWh_mean"]].round(3).to_csv("out/month.csv")
-
-    # 3.2 plotting
-    # add last values for plotting
-    today = pd.Timestamp.now().normalize()
-    for df in (df_week, df_month):
-        last_values = df.iloc[-1]
-        df.loc[today] = last_values  # type: ignore
-    plot_kwh_vs_date(df_day, "day", kwh_sum=KWH_SUM, kwh_max=ceil(MAX_KWH_PER_DAY))
-    plot_kwh_vs_date(df_week, "week", kwh_sum=KWH_SUM)
-    plot_kwh_vs_date(df_month, "month", kwh_sum=KWH_SUM)
-    plot_kwh_date_mean(df_day, df_week, df_month, kwh_sum=KWH_SUM)
-    plot_last_14_days(df_hour_14d)
-
-    # 4. how many hours per day did I reach a certain kWh target
-    for wh_target in (50, 100, 200):
-        df = prepare_df_hours_goal_reached(df_hour, wh_target=wh_target)
-        plot_hours_goal_reached(df, wh_target=wh_target)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # 3.1 export, written by background threads during plotting
+        # column selections are copies, so adding plot values below does not interfere
+        futures = [
+            executor.submit(df_day["kWh"].to_csv, "out/day.csv", float_format="%.3f"),
+            executor.submit(
+                df_week[["kWh_sum", "kWh_mean"]].to_csv,
+                "out/week.csv",
+                float_format="%.3f",
+            ),
+            executor.submit(
+                df_month[["kWh_sum", "kWh_mean"]].to_csv,
+                "out/month.csv",
+                float_format="%.3f",
+            ),
+        ]
+
+        # 3.2 plotting
+        # stays in main thread, as pyplot state is global and not thread-safe
+        # add last values for plotting
+        today = pd.Timestamp.now().normalize()
+        for df in (df_week, df_month):
+            last_values = df.iloc[-1]
+            df.loc[today] = last_values  # type: ignore
+        # one Figure and Axes for the kWh vs date charts, cleared in between
+        fig, ax = plt.subplots(num=FIG_NUM_REUSED, clear=True)
+        plot_kwh_vs_date(
+            df_day, "day", kwh_sum=KWH_SUM, kwh_max=ceil(MAX_KWH_PER_DAY), ax=ax
+        )
+        plot_kwh_vs_date(df_week, "week", kwh_sum=KWH_SUM, ax=ax)
+        plot_kwh_vs_date(df_month, "month", kwh_sum=KWH_SUM, ax=ax)
+        plot_kwh_date_mean(df_day, df_week, df_month, kwh_sum=KWH_SUM)
+        plot_last_14_days(df_hour_14d)
+
+        # 4. how many hours per day did I reach a certain kWh target
+        d = prepare_df_hours_goal_reached(df_hour, wh_targets=(50, 100, 200))
+        for wh_target, df in d.items():
+            plot_hours_goal_reached(df, wh_target=wh_target)
+
+        # wait for export, raises its exceptions
+        for future in futures:
+            future.result()